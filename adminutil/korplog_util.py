@@ -7,10 +7,70 @@ backend log data.
 """
 
 
-import re
+import calendar
 import time
 
 
+# Cache of seconds since the epoch for (date, time) string pairs: log
+# entries typically repeat the same timestamp many times, and
+# time.strptime is slow.
+_secs_cache = {}
+_SECS_CACHE_MAXSIZE = 4096
+
+
+def _parse_secs(date_s, time_s):
+    """Return seconds since the epoch for local date_s and time_s.
+
+    date_s is of the form YYYY-MM-DD and time_s HH:MM:SS. Raise
+    ValueError if they cannot be parsed or a value is out of range.
+    """
+    key = (date_s, time_s)
+    secs = _secs_cache.get(key)
+    if secs is None:
+        # Parse the fixed format directly instead of with
+        # time.strptime, which is considerably slower. Unpacking
+        # raises ValueError if a value has a wrong number of parts.
+        # Whitespace between the date and time is allowed, as the
+        # space in the strptime format matched any whitespace.
+        year, month, day = date_s.rstrip().split('-')
+        hour, mins, sec = time_s.lstrip().split(':')
+        secs = int(time.mktime(
+            _check_time_fields(year, month, day, hour, mins, sec)
+            + (0, 0, -1)))
+        if len(_secs_cache) >= _SECS_CACHE_MAXSIZE:
+            _secs_cache.clear()
+        _secs_cache[key] = secs
+    return secs
+
+
+def _check_time_fields(year, month, day, hour, mins, sec):
+    """Return the date and time field strings as a tuple of ints.
+
+    Accept the same values as time.strptime with '%Y-%m-%d %H:%M:%S':
+    a four-digit year, other fields of one or two digits (the day
+    may also be a space followed by a digit), and values within their
+    ranges. Raise ValueError otherwise, since time.mktime would
+    silently normalize out-of-range values.
+    """
+    if len(day) == 2 and day[0] == ' ':
+        day = day[1:]
+    if not (len(year) == 4
+            and all(0 < len(field) <= 2
+                    for field in (month, day, hour, mins, sec))
+            and all(field.isdigit()
+                    for field in (year, month, day, hour, mins, sec))):
+        raise ValueError('malformed date or time')
+    fields = (int(year), int(month), int(day), int(hour), int(mins),
+              int(sec))
+    year, month, day, hour, mins, sec = fields
+    if not (year >= 1 and 1 <= month <= 12
+            and 1 <= day
+            and (day <= 28 or day <= calendar.monthrange(year, month)[1])
+            and hour <= 23 and mins <= 59 and sec <= 61):
+        raise ValueError('date or time value out of range')
+    return fields
+
+
 def make_logentry_id(fields):
     """Return an id of the form <ms since epoch> ":" <pid> ":" <request id>"""
     date_s = fields.get('start_date') or fields.get('date') or ''
@@ -20,12 +80,11 @@ def make_logentry_id(fields):
     pid, req = pid.split(':') if ':' in pid else (pid, '0')
     try:
         return '{secs:d}{msecs}:{pid:07d}:{req:016d}'.format(
-            secs=int(time.mktime(time.strptime(date_s + ' ' + time_s,
-                                               '%Y-%m-%d %H:%M:%S'))),
+            secs=_parse_secs(date_s, time_s),
             msecs=msecs,
             pid=int(pid),
             req=int(req))
-    except ValueError:
+    except (ValueError, OverflowError):
         return 'None'
 
 
@@ -42,24 +101,24 @@ def decode_list_param(str_list):
     # Copied from korp.cgi, slightly modified.
     if isinstance(str_list, list):
         return str_list
-    split_val = re.split(r"[.,]", str_list)
     result = []
     prefix = ""
-    for elem in split_val:
+    # Scanning with str methods is considerably faster than matching
+    # a regular expression for each element.
+    for elem in str_list.replace(".", ",").split(","):
         # print elem, prefix, result
-        mo = re.match(r"^([^()]*)([()])?(.*)$", elem)
-        pref, sep, suff = mo.groups()
-        # print prefix, repr([pref, sep, suff])
-        if sep == "(":
+        open_pos = elem.find("(")
+        close_pos = elem.find(")")
+        if open_pos >= 0 and (close_pos < 0 or open_pos < close_pos):
             # new_prefix(suffix
-            prefix = pref
-            result.append(prefix + suff)
-        elif sep == ')':
+            prefix = elem[:open_pos]
+            result.append(prefix + elem[open_pos + 1:])
+        elif close_pos >= 0:
             # last_suffix)
-            result.append(prefix + pref)
+            result.append(prefix + elem[:close_pos])
             prefix = ""
         else:
             # Neither ( nor )
-            result.append(prefix + pref)
+            result.append(prefix + elem)
     # print result
     return result
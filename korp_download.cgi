@@ -1,4 +1,4 @@
-#! /usr/bin/env python2
+#! /usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 """
@@ -62,7 +62,7 @@ import cgi
 import logging
 import urllib.request, urllib.parse, urllib.error
 import time
-import md5
+import hashlib
 
 import korpexport.exporter as ke
 
@@ -88,6 +88,9 @@ LOG_LEVEL = logging.INFO
 # "urn_resolver"
 URN_RESOLVER = "http://urn.fi/"
 
+# The buffer size for the standard output (bytes)
+STDOUT_BUFFER_SIZE = 128 * 1024
+
 
 def main():
     """The main CGI handler, modified from that of korp.cgi.
@@ -105,18 +108,22 @@ def main():
             return s[:maxlen - len(ellipsis) - 10] + ellipsis + s[-10:]
 
     starttime = time.time()
-    # Open unbuffered stdout
-    sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
-    # Convert form fields to regular dictionary with unicode values;
-    # assume that the input is encoded in UTF-8. Note that this does
-    # not handle list values resulting form multiple occurrences of a
+    # Open stdout with a large buffer, so that the headers and the
+    # content are written with few system calls; it is flushed
+    # explicitly after printing the content. The new stream does not
+    # close the file descriptor, which remains owned by sys.__stdout__.
+    sys.stdout.flush()
+    sys.stdout = open(sys.stdout.fileno(), 'w', buffering=STDOUT_BUFFER_SIZE,
+                      encoding='utf-8', closefd=False)
+    # Convert form fields to regular dictionary with str values;
+    # FieldStorage decodes the input as UTF-8. Note that this does not
+    # handle list values resulting form multiple occurrences of a
     # parameter.
-    form_raw = cgi.FieldStorage(keep_blank_values=1)
+    form_raw = cgi.FieldStorage(keep_blank_values=1, encoding="utf-8")
     # Decode \r\n as \n, since a bare \n in parameters seems to get
     # encoded as \r\n.
-    form = dict((field,
-                 form_raw.getvalue(field).decode("utf-8").replace('\r\n', '\n'))
-                 for field in list(form_raw.keys()))
+    form = dict((field, form_raw.getvalue(field).replace('\r\n', '\n'))
+                for field in form_raw.keys())
     # Configure logging
     loglevel = logging.DEBUG if "debug" in form else LOG_LEVEL
     logfile = form.get("logfile")
@@ -145,7 +152,8 @@ def main():
     remote_user = cgi.os.environ.get('REMOTE_USER')
     if remote_user:
         logging.info('Auth-domain: %s', remote_user.partition('@')[2])
-        logging.info('Auth-user: %s', md5.new(remote_user).hexdigest())
+        logging.info('Auth-user: %s',
+                     hashlib.md5(remote_user.encode('utf-8')).hexdigest())
     logging.debug('Env: %s', cgi.os.environ)
     try:
         result = ke.make_download_file(
@@ -165,6 +173,7 @@ def main():
     # Print HTTP header and content
     print_header(result)
     print_object(result)
+    sys.stdout.flush()
     if 'download_content' in result:
         logging.info('Content-length: %d', len(result['download_content']))
     logging.info('CPU-load: %s', ' '.join(str(val) for val in os.getloadavg()))
@@ -248,7 +257,15 @@ def print_object(obj):
         if "traceback" in error:
             print(error["traceback"])
     else:
-        print(obj["download_content"], end=' ')
+        content = obj["download_content"]
+        if isinstance(content, bytes):
+            # The content has already been encoded by the exporter, so
+            # write it as such to the underlying binary stream, after
+            # the headers written to the text stream
+            sys.stdout.flush()
+            sys.stdout.buffer.write(content)
+        else:
+            print(content, end=' ')
 
 
 if __name__ == "__main__":
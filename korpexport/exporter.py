@@ -14,6 +14,7 @@ generate downloadable file contents.
 
 
 import importlib  #
+import gzip
 import os.path
 import time
 import pkgutil
@@ -25,6 +26,11 @@ import logging
 from subprocess import Popen, PIPE
 from collections import defaultdict
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 import korpexport.queryresult as qr
 
 
@@ -33,6 +39,15 @@ __all__ = ['make_download_file',
            'KorpExporter']
 
 
+# Delimiters of list-valued query parameters
+_LIST_PARAM_DELIM = ","
+_LIST_PARAM_DELIM_ALT = "."
+
+# Regular expressions used by KorpExporter
+_FORMAT_NAMES_SPLIT_RE = re.compile(r"[,;+\s]+")
+_CQP_STRING_RE = re.compile(r'\"((?:[^\\\"]|\\.)*?)\"')
+
+
 def make_download_file(form, korp_server_url, **kwargs):
     """Format Korp query results and return them in a downloadable format.
 
@@ -59,41 +74,54 @@ def make_download_file(form, korp_server_url, **kwargs):
     return exporter.make_download_file(korp_server_url, **kwargs)
 
 
+def _load_json(json_text):
+    """Decode the JSON (str or bytes) json_text, using orjson if available.
+
+    orjson parses large Korp query results considerably faster than
+    the json module. Fall back to json for input that orjson rejects
+    but json accepts, such as NaN.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(json_text)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(json_text)
+
+
 def _decode_list_param(str_list, alt_delim=None):
     """Decode a list-valued parameter str_list into a list of strings by
-    splitting at QUERY_DELIM (comma) and the characters in alt_delim
-    (QUERY_DELIM_ALT by default). Also expand one level of common
-    prefixes with suffixes marked with parentheses: LAM_A(HLA,NTR) ->
-    LAM_AHLA,LAM_ANTR (nesting parentheses is not allowed).
+    splitting at _LIST_PARAM_DELIM (comma) and the characters in
+    alt_delim (_LIST_PARAM_DELIM_ALT by default). Also expand one
+    level of common prefixes with suffixes marked with parentheses:
+    LAM_A(HLA,NTR) -> LAM_AHLA,LAM_ANTR (nesting parentheses is not
+    allowed).
     """
     # This function is slightly modified from decode_list_param in
     # korp.cgi. It would probably be better to have a single function
     # in a utility module.
-    QUERY_DELIM = ","
-    QUERY_DELIM_ALT = "."
     if alt_delim is None:
-        alt_delim = QUERY_DELIM_ALT
-    if alt_delim:
-        split_val = re.split(r"[" + QUERY_DELIM + alt_delim + r"]",
-                             str_list)
-    else:
-        split_val = str_list.split(QUERY_DELIM)
+        alt_delim = _LIST_PARAM_DELIM_ALT
+    for delim in alt_delim:
+        str_list = str_list.replace(delim, _LIST_PARAM_DELIM)
     result = []
     prefix = ""
-    for elem in split_val:
-        mo = re.match(r"^([^()]*)([()])?(.*)$", elem)
-        pref, sep, suff = mo.groups()
-        if sep == "(":
+    # Scanning with str methods is considerably faster than matching
+    # a regular expression for each element.
+    for elem in str_list.split(_LIST_PARAM_DELIM):
+        open_pos = elem.find("(")
+        close_pos = elem.find(")")
+        if open_pos >= 0 and (close_pos < 0 or open_pos < close_pos):
             # new_prefix(suffix
-            prefix = pref
-            result.append(prefix + suff)
-        elif sep == ')':
+            prefix = elem[:open_pos]
+            result.append(prefix + elem[open_pos + 1:])
+        elif close_pos >= 0:
             # last_suffix)
-            result.append(prefix + pref)
+            result.append(prefix + elem[:close_pos])
             prefix = ""
         else:
             # Neither ( nor )
-            result.append(prefix + pref)
+            result.append(prefix + elem)
     return result
 
 
@@ -111,9 +139,30 @@ class KorpExporter(object):
     _FORMATTER_SUBPACKAGE = "format"
     """The `korpexport` subpackage containing actual formatter modules"""
 
+    _FORMATTER_SUBPACKAGE_PATH = os.path.join(os.path.dirname(__file__),
+                                              _FORMATTER_SUBPACKAGE)
+    """The directory of the formatter subpackage"""
+
     _filename_format_default = "korp_kwic_{cqpwords:.60}_{date}_{time}{ext}"
     """Default filename format"""
 
+    _formatter_classes = {}
+    """Formatter classes found in the formatter modules scanned so far,
+       keyed by format name"""
+
+    _scanned_formatter_modules = set()
+    """Names of the formatter modules already imported (or failed to
+       import) and scanned for formatter classes"""
+
+    _combined_formatter_classes = {}
+    """Formatter classes constructed for multiple formats, keyed by
+       the tuple of their base classes"""
+
+    _filename_replace_chars_res = {}
+    """Compiled regular expressions for the characters to replace in
+       the CQP query part of a filename, keyed by the characters to
+       keep"""
+
     _ENCODED_LIST_QUERY_PARAMS = [
         "corpus",
         "show",
@@ -183,6 +232,10 @@ class KorpExporter(object):
         result["download_charset"] = self._formatter.download_charset
         content = self._formatter.make_download_content(
             self._query_result, self._query_params, self._opts, **kwargs)
+        # The formatter builds the content by joining lists of
+        # strings, so encoding it here once as a whole is cheaper than
+        # encoding each sentence separately; post-processing (quoting,
+        # newline conversion) needs the content as a string.
         if isinstance(content, str) and self._formatter.download_charset:
             content = content.encode(self._formatter.download_charset)
         result["download_content"] = content
@@ -240,10 +293,12 @@ class KorpExporter(object):
         may modify. For example, the main format may be a logical
         content format, for which the second format specifies a
         concrete representation: for example, a token per line content
-        format represented as comma-separated values.
+        format represented as comma-separated values. A constructed
+        class is cached and reused for the same combination of
+        formats.
         """
         if isinstance(format_names, str):
-            format_names = re.split(r"[,;+\s]+", format_names)
+            format_names = _FORMAT_NAMES_SPLIT_RE.split(format_names)
         if len(format_names) == 1:
             return self._find_formatter_class(format_names[0])
         else:
@@ -253,11 +308,16 @@ class KorpExporter(object):
             # constructed
             for format_name in format_names:
                 base_classes.append(self._find_formatter_class(format_name))
+            base_classes = tuple(base_classes)
+            formatter_class = self._combined_formatter_classes.get(
+                base_classes)
+            if formatter_class is not None:
+                return formatter_class
             classname = "_" + "_".join(cls.__name__ for cls in base_classes)
             # First construct the class object (without methods), so
             # that we can refer to it in super() in the __init__()
             # method
-            formatter_class = type(classname, tuple(base_classes), {})
+            formatter_class = type(classname, base_classes, {})
 
             # Then define the function to be added as an __init__ method
             def __init__(self, **kwargs):
@@ -265,6 +325,7 @@ class KorpExporter(object):
 
             # And finally add it to the formatter class as __init__
             setattr(formatter_class, "__init__", __init__)
+            self._combined_formatter_classes[base_classes] = formatter_class
             return formatter_class
 
     def _find_formatter_class(self, format_name):
@@ -282,14 +343,21 @@ class KorpExporter(object):
 
         Searches for a formatter in the classes of
         package:`korpexport.format` modules, and returns the first
-        whose `format` attribute contains `format_name`.
+        whose `format` attribute contains `format_name`. Each module
+        is imported and scanned at most once: the classes found in it
+        are registered for all their formats in
+        `self._formatter_classes`, and the search stops at the first
+        module providing `format_name`.
         """
-        pkgpath = os.path.join(os.path.dirname(__file__),
-                               self._FORMATTER_SUBPACKAGE)
-
-        for _, module_name, _ in pkgutil.iter_modules([pkgpath]):
+        if format_name in self._formatter_classes:
+            return self._formatter_classes[format_name]
+        for _, module_name, _ in pkgutil.iter_modules(
+                [self._FORMATTER_SUBPACKAGE_PATH]):
             module_pth = self._FORMATTER_SUBPACKAGE + "." + module_name
             module_pth = 'korpexport.' + module_pth  # TODO Temporary hack!
+            if module_pth in self._scanned_formatter_modules:
+                continue
+            self._scanned_formatter_modules.add(module_pth)
             try:
                 #subpkg = __import__(module_pth, globals())  #
                 module = importlib.import_module(module_pth)
@@ -297,13 +365,16 @@ class KorpExporter(object):
                 print('ImportError:', module_pth)
                 continue
             #module = getattr(subpkg, module_name)  #
-            for name in dir(module):
+            for module_class in vars(module).values():
                 try:
-                    module_class = getattr(module, name)
-                    if format_name in module_class.formats:
-                        return module_class
+                    module_formats = module_class.formats
                 except AttributeError as e:
-                    pass
+                    continue
+                for module_format in module_formats:
+                    self._formatter_classes.setdefault(module_format,
+                                                       module_class)
+            if format_name in self._formatter_classes:
+                return self._formatter_classes[format_name]
         raise KorpExportError("No formatter found for format '{0}'"
                               .format(format_name))
 
@@ -318,18 +389,20 @@ class KorpExporter(object):
         the result obtained by performing a query to the Korp server
         at `korp_server_url`. The query parameters are retrieved from
         argument `query_params`, form field `query_params` (as JSON)
-        or the form as a whole.
+        or the form as a whole. The values of the form fields
+        `query_result` and `query_params` may also be dicts instead of
+        JSON, in which case they are used as such.
 
         Set a private attribute to contain the result, a dictionary
         converted from the JSON returned by Korp.
         """
         if "query_result" in self._form:
-            query_result_json = self._form.get("query_result", "{}")
+            self._query_result = self._get_json_form_param("query_result")
         else:
             if query_params:
                 self._query_params = query_params
             elif "query_params" in self._form:
-                self._query_params = json.loads(self._form.get("query_params"))
+                self._query_params = self._get_json_form_param("query_params")
             else:
                 self._query_params = self._form
             self._rename_query_params()
@@ -340,26 +413,46 @@ class KorpExporter(object):
             # structs in param "show_struct" to "show", so that tokens
             # are associated with information on opening and closing
             # those structures. Param "show_struct" only gives us
-            # struct attribute values for a whole sentence.
+            # struct attribute values for a whole sentence. Add only
+            # the structs not already in "show", so that processing the
+            # same query params again (they may be the form itself)
+            # does not add them again.
             if (self._formatter.structured_format
                 and self._query_params.get("show_struct")):
                 if self._query_params.get("show"):
-                    self._query_params["show"] += (
-                        "," + self._query_params["show_struct"])
+                    show = self._query_params["show"].split(",")
+                    show_struct = self._query_params["show_struct"].split(",")
+                    add_show = [struct for struct in show_struct
+                                if struct not in show]
+                    if add_show:
+                        self._query_params["show"] = ",".join(show + add_show)
                 else:
                     self._query_params["show"] = self._query_params["show_struct"]
             logging.debug("query_params: %s", self._query_params)
-            query_result_json = self._query_korp_server(korp_server_url)
+            self._query_result = _load_json(
+                self._query_korp_server(korp_server_url))
             # Support "sort" in format params even if not specified
             if "sort" not in self._query_params:
                 self._query_params["sort"] = "none"
-        self._query_result = json.loads(query_result_json)
         logging.debug("query result: %s", self._query_result)
         if "ERROR" in self._query_result or "kwic" not in self._query_result:
             return
         self._opts = self._extract_options(korp_server_url)
         logging.debug("opts: %s", self._opts)
 
+    def _get_json_form_param(self, param_name):
+        """Return the value of form parameter `param_name` decoded from JSON.
+
+        If the value is not a string (or bytes), it is assumed to have
+        been decoded already (for example, a dict passed by a caller
+        of :func:`make_download_file`) and is returned as is, to avoid
+        encoding it in JSON only to decode it here.
+        """
+        value = self._form[param_name]
+        if isinstance(value, (str, bytes)):
+            value = _load_json(value)
+        return value
+
     def _rename_query_params(self):
         for (orig, renamed) in self._RENAME_QUERY_PARAMS:
             if orig in self._query_params:
@@ -384,6 +477,10 @@ class KorpExporter(object):
             str: The value returned by the Korp server, most probably
                 an object encoded in JSON
 
+        Raises:
+            KorpExportError: If the Korp server program exits with a
+                non-zero status
+
         If `url_or_progname` begins with "http", make a query via
         HTTP. Otherwise assume it as program name and call it directly
         as a subprocess but make it believe that it is run via CGI.
@@ -411,16 +508,28 @@ class KorpExporter(object):
             query_params["loginfo"] += " " + loginfo_text
         else:
             query_params["loginfo"] = loginfo_text
-        # Encode the query parameters in UTF-8 for Korp server
+        # Encode the query parameters in UTF-8 for Korp server; the
+        # result of urlencode is ASCII, and both urlopen and the
+        # subprocess pipe need it as bytes. List values (possible in
+        # query params passed as a dict) are encoded as repeated
+        # parameters.
         logging.debug("Korp server: %s", url_or_progname)
         logging.debug("Korp query params: %s", query_params)
         query_params_encoded = urllib.parse.urlencode(
-            dict((key, val.encode("utf-8"))
-                 for key, val in query_params.items()))
+            query_params, doseq=True, encoding="utf-8").encode("ascii")
         logging.debug("Encoded query params: %s", query_params_encoded)
         logging.debug("Env: %s", os.environ)
         if url_or_progname.startswith("http"):
-            return urllib.request.urlopen(url_or_progname, query_params_encoded).read()
+            # Ask for a compressed response: Korp query results in JSON
+            # typically shrink considerably
+            request = urllib.request.Request(
+                url_or_progname, query_params_encoded,
+                {"Accept-Encoding": "gzip"})
+            response = urllib.request.urlopen(request)
+            result = response.read()
+            if response.headers.get("Content-Encoding") == "gzip":
+                result = gzip.decompress(result)
+            return result
         else:
             env = {}
             # Pass the environment of this scropt appropriately
@@ -442,10 +551,17 @@ class KorpExporter(object):
                  "CONTENT_LENGTH": str(len(query_params_encoded))})
             logging.debug("Env modified: %s", env)
             p = Popen(url_or_progname, stdin=PIPE, stdout=PIPE, env=env)
-            output = p.communicate(query_params_encoded)[0]
-            logging.debug("Korp server output: %s", output)
+            output, _ = p.communicate(query_params_encoded)
+            if p.returncode != 0:
+                raise KorpExportError(
+                    "Korp server program {0} exited with status {1}"
+                    .format(url_or_progname, p.returncode))
             # Remove HTTP headers from the result
-            return re.sub(r"(?s)^.*?\n\n", "", output, count=1)
+            _, sep, body = output.partition(b"\n\n")
+            if sep:
+                output = body
+            logging.debug("Korp server output: %s", output)
+            return output
 
     def _extract_options(self, korp_server_url=None):
         """Extract formatting options from form, affected by query params.
@@ -483,11 +599,13 @@ class KorpExporter(object):
             if opt_name in self._form:
                 vals = self._form.get(opt_name, "").split(",")
                 new_vals = []
-                for valnum, val in enumerate(vals):
+                all_vals = None
+                for val in vals:
                     if val in ["*", "+"]:
-                        all_vals = (
-                            self._query_params.get(query_param_name, "")
-                            .split(","))
+                        if all_vals is None:
+                            all_vals = (
+                                self._query_params.get(query_param_name, "")
+                                .split(","))
                         if val == "+":
                             add_vals = qr.get_occurring_attrnames(
                                 self._query_result, all_vals,
@@ -496,9 +614,12 @@ class KorpExporter(object):
                             add_vals = all_vals
                         new_vals.extend(add_vals)
                     elif val.startswith("-"):
-                        valname = val[1:]
-                        if valname in new_vals:
-                            new_vals.remove(valname)
+                        # Remove the first occurrence, if any, scanning
+                        # the list only once
+                        try:
+                            new_vals.remove(val[1:])
+                        except ValueError:
+                            pass
                     else:
                         new_vals.append(val)
                 opts[opt_name] = new_vals
@@ -524,11 +645,21 @@ class KorpExporter(object):
         Also add ``corpus_config`` to each hit if available.
         """
         self._retrieve_corpus_info(korp_server_url)
+        # Hits typically come from only a few corpora, so look up the
+        # information only once for each distinct value of "corpus"
+        corpus_hit_infos = {}
         for query_hit in query_result["kwic"]:
-            corpname = query_hit["corpus"].partition("|")[0].lower()
-            query_hit["corpus_info"] = self._corpus_info.get(corpname)
+            corpus = query_hit["corpus"]
+            hit_info = corpus_hit_infos.get(corpus)
+            if hit_info is None:
+                corpname = corpus.partition("|")[0].lower()
+                hit_info = corpus_hit_infos[corpus] = (
+                    self._corpus_info.get(corpname),
+                    (self._corpus_config[corpname] if self._corpus_config
+                     else None))
+            query_hit["corpus_info"] = hit_info[0]
             if self._corpus_config:
-                query_hit["corpus_config"] = self._corpus_config[corpname]
+                query_hit["corpus_config"] = hit_info[1]
 
     def _retrieve_corpus_info(self, korp_server_url):
         """Retrieve corpus info from the form or from a Korp server.
@@ -542,14 +673,14 @@ class KorpExporter(object):
         For the corpus information on the form, the form parameter
         ``corpus_info`` is preferred; if not available, use values in
         ``corpus_config``. These parameters need to be encoded in
-        JSON.
+        JSON, unless they are passed as dicts.
         """
         self._corpus_info = defaultdict(dict)
         self._corpus_config = {}
         if "corpus_info" in self._form:
-            self._corpus_info = json.loads(self._form["corpus_info"])
+            self._corpus_info = self._get_json_form_param("corpus_info")
         elif "corpus_config" in self._form:
-            self._corpus_config = json.loads(self._form["corpus_config"])
+            self._corpus_config = self._get_json_form_param("corpus_config")
             self._corpus_info = dict(
                 [(corpname.lower(), config.get("info"))
                  for corpname, config in self._corpus_config.items()])
@@ -571,17 +702,21 @@ class KorpExporter(object):
             else [])
         for corpname, config in self._corpus_config.items():
             corpname = corpname.lower()
+            corpus_info = self._corpus_info.setdefault(corpname, {})
             for confkey, confval in config.items():
                 confkey = confkey.lower()
                 if (confkey in ["urn", "url"] or confkey.endswith("_urn")
                     or confkey.endswith("_url")):
-                    self._add_corpus_info_item(corpname, confkey, confval)
+                    self._add_corpus_info_item(
+                        corpname, confkey, confval, corpus_info)
                 elif confkey in config_info_items:
                     for subkey, subval in confval.items():
                         self._add_corpus_info_item(
-                            corpname, confkey + "_" + subkey, subval)
+                            corpname, confkey + "_" + subkey, subval,
+                            corpus_info)
 
-    def _add_corpus_info_item(self, corpname, infoname, infovalue):
+    def _add_corpus_info_item(self, corpname, infoname, infovalue,
+                              corpus_info=None):
         """Add a corpus info item to `self._corpus_info`.
 
         Add to `self._corpus_info` for corpus `corpname` the
@@ -589,16 +724,17 @@ class KorpExporter(object):
         `infoname` contains an underscore, split the name at it and
         use the first part as the name of a substructure (`dict`)
         containing the second part as a key. `infoname` is lowercased.
+        If `corpus_info` is specified, it is used as the info of
+        `corpname` in `self._corpus_info`, so that callers adding
+        several items for a corpus need to look it up only once.
         """
-        infoname = infoname.lower()
-        subinfoname = None
-        if "_" in infoname:
-            infoname, _, subinfoname = infoname.partition("_")
-        if infoname not in self._corpus_info.setdefault(corpname, {}):
-            self._corpus_info[corpname][infoname] = (
-                {} if subinfoname else infovalue)
+        if corpus_info is None:
+            corpus_info = self._corpus_info.setdefault(corpname, {})
+        infoname, _, subinfoname = infoname.lower().partition("_")
+        if infoname not in corpus_info:
+            corpus_info[infoname] = {} if subinfoname else infovalue
         if subinfoname:
-            self._corpus_info[corpname][infoname][subinfoname] = infovalue
+            corpus_info[infoname][subinfoname] = infovalue
 
     def _retrieve_corpus_info_from_server(self, korp_server_url):
         """Retrieve corpus info from the server `korp_server_url`.
@@ -615,12 +751,16 @@ class KorpExporter(object):
         #korp_corpus_info_json = self._query_korp_server(korp_server_url,
         #                                                korp_info_params)  #
         korp_corpus_info_json = '{}'  # TODO Temporary hack: Override info from server.
-        korp_corpus_info = json.loads(korp_corpus_info_json)
+        korp_corpus_info = _load_json(korp_corpus_info_json)
         for corpname, corpdata in (iter(korp_corpus_info.get("corpora", {}).items())):
             corpname = corpname.lower()
             corpinfo = corpdata.get("info", {})
+            if not corpinfo:
+                continue
+            corpus_info = self._corpus_info.setdefault(corpname, {})
             for infoname, infoval in corpinfo.items():
-                self._add_corpus_info_item(corpname, infoname, infoval)
+                self._add_corpus_info_item(
+                    corpname, infoname, infoval, corpus_info)
 
     def _get_corpus_names(self):
         """Return the names (ids) of corpora present in the query results.
@@ -628,9 +768,12 @@ class KorpExporter(object):
         For parallel corpora, return all the names (ids) of all
         aligned corpora.
         """
-        return set([corpname
-                    for corpus_hit in self._query_result.get("kwic", [])
-                    for corpname in corpus_hit["corpus"].split("|")])
+        # Split each distinct value of "corpus" only once
+        corpora = set(corpus_hit["corpus"]
+                      for corpus_hit in self._query_result.get("kwic", []))
+        return set(corpname
+                   for corpus in corpora
+                   for corpname in corpus.split("|"))
 
     def _get_filename(self):
         """Return the filename for the result, from form or formatted.
@@ -648,19 +791,23 @@ class KorpExporter(object):
         - start: The number of the first result
         - end: The number of the last result
         """
-        # FIXME: Get a time first and then format it, to avoid the
-        # unlikely possibility of date changing between formatting the
-        # date and time.
+        if "filename" in self._form:
+            return self._form["filename"].encode(self._filename_encoding)
+        # Get the time once and format both the date and time from it,
+        # so that the date cannot change between formatting them.
         # TODO: User-specified date and time formatting
-        return (self._form.get(
-                "filename",
-                self._filename_format.format(
-                    date=time.strftime("%Y%m%d"),
-                    time=time.strftime("%H%M%S"),
+        now = time.localtime()
+        # Extract the CQP words only if the filename format may use
+        # them
+        cqpwords = (self._make_cqp_filename_repr()
+                    if "cqpwords" in self._filename_format else "")
+        return (self._filename_format.format(
+                    date=time.strftime("%Y%m%d", now),
+                    time=time.strftime("%H%M%S", now),
                     ext=self._formatter.filename_extension,
-                    cqpwords=self._make_cqp_filename_repr(),
+                    cqpwords=cqpwords,
                     start=self._query_params.get("start", ""),
-                    end=self._query_params.get("end", "")))
+                    end=self._query_params.get("end", ""))
                 .encode(self._filename_encoding))
 
     def _make_cqp_filename_repr(self, attrs=False, keep_chars=None,
@@ -680,10 +827,13 @@ class KorpExporter(object):
         """
         # TODO: If attrs is True, include attribute names. Could we
         # encode somehow the operator which could be != or contains?
-        words = re.findall(r'\"((?:[^\\\"]|\\.)*?)\"',
-                           self._query_params.get("cqp", ""))
-        replace_chars_re = re.compile(
-            r'[^\w' + re.escape(keep_chars or "") + ']+', re.UNICODE)
+        words = _CQP_STRING_RE.findall(self._query_params.get("cqp", ""))
+        keep_chars = keep_chars or ""
+        replace_chars_re = self._filename_replace_chars_res.get(keep_chars)
+        if replace_chars_re is None:
+            replace_chars_re = re.compile(
+                r'[^\w' + re.escape(keep_chars) + ']+', re.UNICODE)
+            self._filename_replace_chars_res[keep_chars] = replace_chars_re
         return replace_char.join(replace_chars_re.sub(replace_char, word)
                                  for word in words)
 
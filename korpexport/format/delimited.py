@@ -69,25 +69,107 @@ class KorpExportFormatterDelimited(KorpExportFormatter):
         Add the quotes specified with option ``quotes`` and convert
         tabs to the final field separator.
         """
-        # FIXME: This does not work correctly if fields are not quoted
-        # but the field separator is other than the tab
         if self._opts["quote"]:
-            return "\n".join(self._quote_line(line)
-                             for line in text.split("\n"))
+            if self._can_quote_text():
+                return self._quote_text(text)
+            return self._quote_lines(text)
+        elif self._opts["delimiter"] != "\t":
+            # Without quotes, only the field separator needs to be
+            # converted, and that can be done in a single pass.
+            return text.replace("\t", self._opts["delimiter"])
         else:
             return text
 
+    def _can_quote_text(self):
+        """Test if the whole text can be quoted by `_quote_text`.
+
+        The quoting options may not contain tabs or newlines, and
+        ``replace_quote`` may not be empty.
+        """
+        opts = self._opts
+        return (opts["replace_quote"] != ""
+                and not any(("\t" in opts[optname] or "\n" in opts[optname])
+                            for optname in ["quote", "replace_quote",
+                                            "delimiter"]))
+
+    def _quote_text(self, text):
+        """Add quotes around the fields in all the lines of `text`.
+
+        Quote the whole text in a batch with a few `str.replace`
+        calls, instead of splitting it into lines and fields and
+        quoting each field separately. Empty lines are kept empty, as
+        in `_quote_line`. The quoting options need to satisfy the
+        conditions of `_can_quote_text`.
+        """
+        # The csv module is not used here: it requires splitting the
+        # text into rows and fields in Python, which makes it slower
+        # than even quoting line by line. It also supports only
+        # doubling or escaping quotes, not an arbitrary replace_quote.
+        # A single str.translate with a table mapping the quote, tab
+        # and newline to their replacements would make one pass
+        # instead of three, but it is an order of magnitude slower
+        # than str.replace when the replacements are multi-character.
+        quote = self._opts["quote"]
+        text = (quote
+                + (text.replace(quote, self._opts["replace_quote"])
+                   .replace("\t", quote + self._opts["delimiter"] + quote)
+                   .replace("\n", quote + "\n" + quote))
+                + quote)
+        empty_line_re = re.compile(r"^" + re.escape(quote + quote) + r"$",
+                                   re.MULTILINE)
+        return empty_line_re.sub("", text)
+
+    def _quote_lines(self, text):
+        """Add quotes around the fields in all the lines of `text`.
+
+        Quote the text line by line, as `_quote_line`, but look up
+        the quoting options only once for the whole text instead of
+        for each line.
+        """
+        quote = self._opts["quote"]
+        replace_quote = self._opts["replace_quote"]
+        delimiter = self._opts["delimiter"]
+        if "\t" not in quote and "\t" not in replace_quote:
+            # Quote each line as a whole instead of each field:
+            # replacing the tabs between fields with the delimiter
+            # surrounded by quotes needs fewer temporary strings.
+            field_sep = quote + delimiter + quote
+            return "\n".join(
+                [(quote + line.replace(quote, replace_quote)
+                  .replace("\t", field_sep) + quote)
+                 if line else line
+                 for line in text.split("\n")])
+        return "\n".join(
+            [(delimiter.join([quote + field.replace(quote, replace_quote)
+                              + quote
+                              for field in line.split("\t")])
+              if line else line)
+             for line in text.split("\n")])
+
     def _quote_line(self, line):
         """Add quotes around the fields (separated by tabs) in `line`."""
         if line == "":
             return line
+        elif not self._opts["quote"]:
+            # No need to replace quotes within or to add them around
+            # fields
+            return line.replace("\t", self._opts["delimiter"])
         else:
-            return self._opts["delimiter"].join(self._quote_field(field)
-                                                for field in line.split("\t"))
+            # Inline the work of _quote_field, as this is called for
+            # every line of the result
+            quote = self._opts["quote"]
+            replace_quote = self._opts["replace_quote"]
+            return self._opts["delimiter"].join(
+                [quote + field.replace(quote, replace_quote) + quote
+                 for field in line.split("\t")])
 
     def _quote_field(self, text):
         """Add quotes around `text` and replace quotes within `text`."""
         quote = self._opts["quote"]
+        if not quote:
+            # str.replace with an empty string to be replaced would
+            # still go through the whole text
+            return text
         return quote + text.replace(quote, self._opts["replace_quote"]) + quote
 
 
@@ -245,17 +327,22 @@ class KorpExportFormatterDelimitedSentenceSimple(
         # token formatting in _format_sentence.
         if not mark_matches and token_format == "{word}":
             token_format = None
+        # These do not change from one sentence to another
+        token_attrs = ["word"] + self._sentence_token_attrs
+        hit_num_start = int(self._infoitems["param"].get("start") or 0)
         return self._opts["sentence_sep"].join(
-            self._format_sentence(
+            [self._format_sentence(
                 sent, sentence_num=sentnum, tokens_type_info=tokens_type_info,
                 token_format=token_format, match_format=match_format,
-                mark_matches=mark_matches, **kwargs)
-            for sentnum, sent in enumerate(
-                    qr.get_sentences(self._query_result)))
+                mark_matches=mark_matches, token_attrs=token_attrs,
+                hit_num_start=hit_num_start, **kwargs)
+             for sentnum, sent in enumerate(
+                     qr.get_sentences(self._query_result))])
 
     def _format_sentence(self, sentence, sentence_num=None,
                          tokens_type_info=None, token_format="",
-                         match_format=None, mark_matches=False, **kwargs):
+                         match_format=None, mark_matches=False,
+                         token_attrs=None, hit_num_start=None, **kwargs):
         """Format a single sentence as a list of sentence fields.
 
         Field values are separated by ``sentence_field_sep``.
@@ -286,7 +373,17 @@ class KorpExportFormatterDelimitedSentenceSimple(
         If `token_format` is `None`, output each word (or token
         attribute) as such, with no formatting, faster than using the
         `token_format` ``{word}``.
+
+        `token_attrs` (the token attributes for which to output
+        fields, starting with ``word``) and `hit_num_start` (the
+        number of the first hit) can be passed from
+        :method:`_format_sentences` to avoid recomputing them for each
+        sentence.
         """
+        if token_attrs is None:
+            token_attrs = ["word"] + self._sentence_token_attrs
+        if hit_num_start is None:
+            hit_num_start = int(self._infoitems["param"].get("start") or 0)
         struct = lambda: self._get_formatted_sentence_structs(sentence,
                                                               **kwargs)
         corpus = qr.get_sentence_corpus(sentence)
@@ -303,11 +400,7 @@ class KorpExportFormatterDelimitedSentenceSimple(
             # struct=struct,
             # corpus_info_field=corpus_info,
             sentence_num=sentence_num,
-            hit_num=(int(self._infoitems["param"].get("start") or 0)
-                     + sentence_num))
-        token_sep = self._opts["token_sep"]
-        token_attrs = ["word"]
-        token_attrs.extend(self._sentence_token_attrs)
+            hit_num=hit_num_start + sentence_num)
         token_sep = self._opts["token_sep"]
         match_open = match_format["match_open"]
         match_close = match_format["match_close"]
@@ -355,21 +448,22 @@ class KorpExportFormatterDelimitedSentenceSimple(
                 field_vals[field_name] = token_sep.join(token_list)
         # Allow direct format references to extra keyword arguments,
         # struct names (unformatted values), query info items and
-        # corpus info items.
+        # corpus info items. dict.update accepts the (name, value) pairs
+        # of the structs directly, without an intermediate dict.
         field_vals.update(kwargs)
-        field_vals.update(dict(self._get_sentence_structs(sentence)))
+        field_vals.update(self._get_sentence_structs(sentence))
         field_vals.update(self._infoitems)
         field_vals.update(corpus_info)
-        field_vals.update(
-            dict(corpus_info=lambda: self._format_corpus_info(**field_vals)))
-        field_vals.update(
-            dict(info=lambda: self._format_item("sentence_info", **field_vals)))
+        field_vals["corpus_info"] = (
+            lambda: self._format_corpus_info(**field_vals))
+        field_vals["info"] = (
+            lambda: self._format_item("sentence_info", **field_vals))
         fieldnames = self._opts["sentence_fields"]
         for fieldname in fieldnames:
             if callable(field_vals[fieldname]):
                 field_vals[fieldname] = field_vals[fieldname]()
         return self._opts["sentence_field_sep"].join(
-            str(field_vals[fieldname]) for fieldname in fieldnames)
+            [str(field_vals[fieldname]) for fieldname in fieldnames])
 
 
 class KorpExportFormatterDelimitedToken(KorpExportFormatterDelimited):
@@ -484,7 +578,9 @@ class KorpExportFormatterCSV(KorpExportFormatterDelimited):
     formats. The result contains commas as field separators, and all
     fields are enclosed in double quotes, with internal double quotes
     doubled. The result uses \r\n as newlines, as it is specified in
-    RFC 4180.
+    RFC 4180. Quoting all fields, which RFC 4180 allows, lets
+    `_postprocess` quote the whole text at once, which is faster than
+    writing the rows with the csv module.
 
     This class does not specify the content of the fields.
     """
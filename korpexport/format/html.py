@@ -150,14 +150,15 @@ class KorpExportFormatterHtml(KorpExportFormatter):
         return self._format_item("html_korp_link", **self._infoitems)
 
     def _format_html_lines(self, text):
-        result = []
-        for linenr, line in enumerate(text.rstrip("\n").split("\n")):
-            if linenr >= self._skip_leading_lines:
-                result.append(
-                    self._format_item("html_line",
-                                      line=self._format_html_line(
-                                          line, linenr=linenr)))
-        return "".join(result)
+        # Slice off the skipped lines instead of testing the line
+        # number of each line
+        skip = max(self._skip_leading_lines, 0)
+        return "".join(
+            [self._format_item("html_line",
+                               line=self._format_html_line(line,
+                                                           linenr=linenr))
+             for linenr, line in enumerate(
+                     text.rstrip("\n").split("\n")[skip:], skip)])
 
     def _format_html_line(self, line, linenr=None):
         return (self._format_html_match(line) if self._match_re else line)
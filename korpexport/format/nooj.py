@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 
 """
-Format Korp query results in various delimited fields formats.
- 
+Format Korp query results in NooJ XML.
+
 This module contains Korp result formatters for NooJ XML divided
 into sentences using tag <S>.
 
@@ -26,7 +26,6 @@ annotation structure" box.
 
 
 import re
-import korpexport.queryresult as qr
 from korpexport.formatter import KorpExportFormatter
 
 __all__ = ['KorpExportFormatterNooJ']
@@ -38,20 +37,21 @@ __all__ = ['KorpExportFormatterNooJ']
 class KorpExportFormatterNooJ(KorpExportFormatter):
 
     """
-    Format Korp query results in a delimited fields format.
-
-    The superclass for actual formatters of delimited-fields formats.
-
-    The formatter uses the following options (in `_option_defaults`)
-    in addition to those specified in :class:`KorpExportFormatter`:
-        delimiter (str): The delimiter with which to separate fields
-        quote (str): The quote character around fields
-        replace_quote (str): The string with which to replace quote
-            characters occurring in field values
-
-    The fields returned by the formatting methods should be delimited
-    by tabs; they are converted to the final delimiter in
-    `_postprocess`.
+    Format Korp query results in NooJ XML.
+
+    The superclass for actual NooJ XML formatters. Each sentence is
+    enclosed in ``<S>`` and each token is formatted as an ``<LU>``
+    element with the lemma, the category (part of speech and
+    morphosyntactic description) and dependency relation of the
+    token as attributes. Lemmas that NooJ cannot handle in XML
+    attributes, such as quotes and commas, are replaced with names
+    (`_lemma_renames`).
+
+    In addition to the format keys specified in
+    :class:`KorpExportFormatter`, ``token_format`` may contain
+    ``nooj_attrs`` (the value of the ``CAT`` attribute) and
+    ``nooj_dep`` (the ``ID``, ``DEP`` and ``ID_REF`` attributes, or
+    an empty string if the token has no dependency head).
     """
 
     _option_defaults = {
@@ -72,6 +72,12 @@ class KorpExportFormatterNooJ(KorpExportFormatter):
         "replace_quote": "\"",
         }
 
+    _lemma_renames = {'"': 'QUOTE',
+                      ',': 'COMMA',
+                      '<': 'A_BRACKET_LEFT',
+                      '>': 'A_BRACKET_RIGHT'}
+    """Lemmas renamed to overcome NooJ XML restrictions"""
+
     def __init__(self, *args, **kwargs):
         KorpExportFormatter.__init__(self, *args, **kwargs)
 
@@ -84,11 +90,24 @@ class KorpExportFormatterNooJ(KorpExportFormatter):
 
         if tokens_type == "all":
             return self._format_list(
-                "token", tokens, token_list=tokens, **kwargs)
+                "token", tokens, token_list=tokens,
+                dep_tokens=self._get_dep_tokens(tokens), **kwargs)
         else:
             return ""
 
-    def _format_token(self, token, token_list=None, **kwargs):
+    def _get_dep_tokens(self, tokens):
+        """Return a dict mapping token refs to tokens in `tokens`.
+
+        Include the tokens having a dependency relation attribute.
+        The tokens themselves are included instead of their lemmas,
+        since `_format_token` renames the lemma of each token it has
+        formatted.
+        """
+        return dict((item["ref"], item) for item in tokens
+                    if "deprel" in item)
+
+    def _format_token(self, token, token_list=None, dep_tokens=None,
+                      **kwargs):
         """Format a single token `token`, possibly with attributes.
         
         Format a single token using the format ``token_format``, or
@@ -106,24 +125,22 @@ class KorpExportFormatterNooJ(KorpExportFormatter):
         token attribute names (unformatted values).
         """
 
-        if "lemma" in list(token.keys()):
+        if "lemma" in token:
             lemma_key = "lemma"
         else:
             lemma_key = ""
 
-        dep_lemmas = {}
-        for item in token_list:
-            if 'deprel' in list(item.keys()) and lemma_key:
-                dep_lemmas.update({item['ref']: item[lemma_key]})
-    
-        # rename " and , to overcome NooJ XML-restrictions
-        rename_dict = {'"': 'QUOTE',
-                       ',': 'COMMA',
-                       '<': 'A_BRACKET_LEFT',
-                       '>': 'A_BRACKET_RIGHT'}
+        # The dependency head tokens of the sentence, by ref, are
+        # normally collected once for a sentence in _format_tokens
+        if not lemma_key:
+            dep_tokens = {}
+        elif dep_tokens is None:
+            dep_tokens = self._get_dep_tokens(token_list or [])
+        orig_lemma = token.get(lemma_key)
 
-        if lemma_key and token[lemma_key] in list(rename_dict.keys()):
-            token[lemma_key] = rename_dict[token[lemma_key]]
+        # rename " and , to overcome NooJ XML-restrictions
+        if lemma_key and token[lemma_key] in self._lemma_renames:
+            token[lemma_key] = self._lemma_renames[token[lemma_key]]
         
         if token['msd']:
             token['msd'] = re.sub('>>>', '(', token['msd'])
@@ -140,33 +157,37 @@ class KorpExportFormatterNooJ(KorpExportFormatter):
         '''
         # remove POS if found also in MSD, add default NooJ category
         # marker for unknowns (UNK)
-        if "msd" and "pos" in list(token.keys()):
+        if "msd" and "pos" in token:
             if token["msd"] is None:
                 token["msd"] = "None"
             #token["msd"] = token["msd"].encode("utf8", "replace")
-            token["msd"] = "+".join(list(set(re.split("[\| ;]",
-                                                      token["msd"])) -
-                                         set([token["pos"]])))
-        elif "msd" in list(token.keys()):
+            token["msd"] = "+".join(set(re.split(r"[| ;]", token["msd"]))
+                                    - {token["pos"]})
+        elif "msd" in token:
             token["pos"] = "UNK"
-        elif "pos" in list(token.keys()):
+        elif "pos" in token:
             token["msd"] = ""
         else:
             token["pos"] = "UNK"
             token["msd"] = ""
 
         # format POS and MSD to NooJ standard
-        nooj_attrs = re.sub("\+$", "", "{pos}+{msd}".format(
+        nooj_attrs = re.sub(r"\+$", "", "{pos}+{msd}".format(
             pos=token["pos"].upper(),
             msd=token["msd"].lower()))
 
         # add lemma refenrences
-        if "dephead" in list(token.keys()):
+        if "dephead" in token:
             if token["dephead"] == "0":
                 dep_lemma = token[lemma_key]
                 token["dephead"] = token["ref"]
-            elif token["dephead"] in list(dep_lemmas.keys()):
-                dep_lemma = dep_lemmas[token["dephead"]]
+            elif token["dephead"] in dep_tokens:
+                # The lemma of a head token is renamed only if the
+                # head has already been formatted (precedes this
+                # token); this token itself has its original lemma
+                head_token = dep_tokens[token["dephead"]]
+                dep_lemma = (orig_lemma if head_token is token
+                             else head_token[lemma_key])
             elif token["dephead"] == "_":
                 dep_lemma = "phrase"
             else:
@@ -199,7 +220,7 @@ class KorpExportFormatterNooJ(KorpExportFormatter):
             structs_close=self._format_token_structs_close(token))
 
         # Allow direct format references to attr names
-        format_args.update(dict(self._get_token_attrs(token)))
+        format_args.update(self._get_token_attrs(token))
         format_args.update(kwargs)
         format_args.update({"nooj_attrs": nooj_attrs})
         format_args.update({"nooj_dep": nooj_dep})
@@ -213,44 +234,15 @@ class KorpExportFormatterNooJ(KorpExportFormatter):
 
         return result
 
-    def _postprocess(self, text):
-        """Add quotes around fields in `text` if specified.
-
-        Add the quotes specified with option ``quotes`` and convert
-        tabs to the final field separator.
-        """
-        # FIXME: This does not work correctly if fields are not quoted
-        # but the field separator is other than the tab
-        '''
-        if self._opts["quote"]:
-            return "\n".join(self._quote_line(line)
-                             for line in text.split("\n"))
-        else:
-            return text
-        '''
-        return text
-
-    def _quote_line(self, line):
-        """Add quotes around the fields (separated by tabs) in `line`."""
-        if line == "":
-            return line
-        else:
-            return self._opts["delimiter"].join(self._quote_field(field)
-                                                for field in line.split("\t"))
-
-    def _quote_field(self, text):
-        """Add quotes around `text` and replace quotes within `text`."""
-        quote = self._opts["quote"]
-        return quote + text.replace(quote, self._opts["replace_quote"]) + quote
 
-class KorpExportFormatterCSV(KorpExportFormatterNooJ):
+class KorpExportFormatterNooJXML(KorpExportFormatterNooJ):
 
     r"""
-    Format Korp results in comma-separated values format, sentence per line.
+    Format Korp results in NooJ XML, sentence per line.
 
-    Handle the format type ``csv``.
+    Handle the format type ``nooj``.
 
-    The result uses \r\n as newlines, as it is specified in RFC 4180.
+    The result uses \r\n as newlines.
     """
 
     formats = ["nooj"]
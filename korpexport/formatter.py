@@ -400,6 +400,31 @@ class KorpExportFormatter(object):
     _formatter = _LazyPartialStringFormatter(missing="[none]")
     """A string formatter: missing keys in formats shown as ``[none]``."""
 
+    _format_key_re = re.compile(r"[A-Za-z_][A-Za-z0-9_]*\Z")
+    """A regular expression matching a plain format key: a key without
+    attribute or index references."""
+
+    _compiled_formats = {}
+    """Format strings that `_format_item` can fill without the string
+    formatter: maps a format string to a tuple of tuples (literal
+    text, key name, format spec) for each plain key in it, followed by
+    (literal text, `None`, `None`) for the trailing literal text (if
+    any), or to `False` if the format string contains other kinds of
+    replacement fields."""
+
+    _sentence_tokens_types = (
+        ("tokens", "all"),
+        ("match", "match"),
+        ("left_context", "left_context"),
+        ("right_context", "right_context"),
+    )
+    """The kinds of tokens of a sentence: pairs (sentence format key,
+    token type for :func:`queryresult.get_sentence_tokens`)."""
+
+    _combined_values_cache = {}
+    """Cached results of `_get_combined_values`, keyed by (class,
+    attribute name)."""
+
     def __init__(self, **kwargs):
         """Construct a formatter instance.
 
@@ -428,6 +453,18 @@ class KorpExportFormatter(object):
         self._query_params = {}
         self._query_result = {}
         self._corpus_info = {}
+        self._sentence_structnames = []
+        self._sentence_fields = []
+        self._token_attrnames = []
+        self._token_fields = []
+        self._token_format_name = "token_noattrs"
+        self._token_attrs_as_values = False
+        self._combine_token_structs = False
+        self._token_match_marks = ("", "", "")
+        self._tokens_as_words = False
+        self._list_skip_res = {}
+        self._formatted_date = None
+        self._formatted_params = None
 
     @classmethod
     def _get_combined_values(cls, attrname):
@@ -436,15 +473,22 @@ class KorpExportFormatter(object):
         The returned dict contains values of the class attribute
         `attrname` from all superclasses so that values from classes
         earlier in the MRO override values from those later.
+
+        The values are combined only once per class and attribute;
+        the returned dict is a copy of the cached one.
         """
-        combined_values = {}
-        # Skip the last class in MRO, since it is `object`.
-        for superclass in reversed(cls.__mro__[:-1]):
-            try:
-                combined_values.update(getattr(superclass, attrname))
-            except AttributeError:
-                pass
-        return combined_values
+        cache_key = (cls, attrname)
+        combined_values = cls._combined_values_cache.get(cache_key)
+        if combined_values is None:
+            combined_values = {}
+            # Skip the last class in MRO, since it is `object`.
+            for superclass in reversed(cls.__mro__[:-1]):
+                try:
+                    combined_values.update(getattr(superclass, attrname))
+                except AttributeError:
+                    pass
+            cls._combined_values_cache[cache_key] = combined_values
+        return dict(combined_values)
 
     def get_options(self):
         """Get the options in effect (a dict)."""
@@ -493,6 +537,7 @@ class KorpExportFormatter(object):
         self._adjust_opts()
         self._init_sentence_token_attrs()
         self._init_infoitems()
+        self._init_format_opts()
         return self._convert_newlines(
             self._postprocess(self._format_content(**kwargs)))
 
@@ -535,8 +580,18 @@ class KorpExportFormatter(object):
             # attribute name ends in an "e".
             mo = re.match(
                 r'(.*?)e?s_(?:all|match|(?:left|right)_context)', item)
-            return mo and qr.get_occurring_attrnames(self._query_result,
-                                                     [mo.group(1)], 'tokens')
+            if not mo:
+                return mo
+            # The same attribute typically appears in fields of
+            # several token types, so check its occurrence in the
+            # whole query result only once.
+            attrname = mo.group(1)
+            if attrname not in occurring_token_attrs:
+                occurring_token_attrs[attrname] = qr.get_occurring_attrnames(
+                    self._query_result, [attrname], 'tokens')
+            return occurring_token_attrs[attrname]
+
+        occurring_token_attrs = {}
 
         available_corpus_info = qr.get_occurring_corpus_info(self._query_result)
         if "urn" in available_corpus_info or "url" in available_corpus_info:
@@ -601,7 +656,12 @@ class KorpExportFormatter(object):
         ``title``: a "title" for the file
         ``korp_url``: URL of the Korp service (frontend) used
         ``korp_server_url``: URL of the Korp server (backend) used
+
+        The date and the query parameters are formatted at most once
+        for the content, even if referred to in several places.
         """
+        self._formatted_date = None
+        self._formatted_params = None
         self._infoitems = dict(
             params=lambda: self._format_params(),
             # Also allow format references {param[name]}
@@ -615,6 +675,45 @@ class KorpExportFormatter(object):
             korp_url=self._opts.get("korp_url"),
             korp_server_url=self._opts.get("korp_server_url"))
 
+    def _init_format_opts(self):
+        """Initialize option values used for every sentence or token.
+
+        The options do not change during formatting, so look them up
+        only once instead of for each sentence or token.
+        """
+        self._sentence_structnames = self._opts.get("structs", [])
+        self._sentence_fields = self._opts.get("sentence_fields", [])
+        self._list_skip_res = {}
+        self._token_attrnames = self._opts.get("attrs", [])
+        self._token_fields = self._opts.get("token_fields", [])
+        self._token_format_name = (
+            "token" if (self._token_attrnames or self.structured_format
+                        or len(self._token_fields) > 1)
+            else "token_noattrs")
+        # If token attributes are formatted as their values only, they
+        # can be joined directly without formatting each one.
+        self._token_attrs_as_values = (
+            self._opts.get("attr_format") == "{value}"
+            and not self._opts.get("attr_skip"))
+        self._combine_token_structs = self.get_option_bool(
+            "combine_token_structs")
+        # The match open, close and marker strings, checked for
+        # every token when marking matches
+        self._token_match_marks = tuple(
+            self._opts.get(optname, "")
+            for optname in ["match_open", "match_close", "match_marker"])
+        # If a token is formatted as its plain wordform, the tokens of
+        # a sentence can be joined directly without formatting each
+        # one. This requires that _format_token is not overridden.
+        self._tokens_as_words = (
+            self._token_format_name == "token_noattrs"
+            and self._opts.get("word_format") == "{word}"
+            and not self._opts.get("token_skip")
+            and (self._opts.get("token_noattrs_format")
+                 == "{match_open}{word}{match_close}")
+            and (type(self)._format_token
+                 is KorpExportFormatter._format_token))
+
     def _convert_newlines(self, text):
         """Return `text` with newlines as specified in option ``newline``."""
         if self._opts["newline"] != "\n":
@@ -639,7 +738,7 @@ class KorpExportFormatter(object):
         otherwise get all structs.
         """
         return qr.get_sentence_structs(
-            sentence, None if all_structs else self._opts.get("structs", []))
+            sentence, None if all_structs else self._sentence_structnames)
 
     def _get_formatted_sentence_structs(self, sentence, **kwargs):
         """Get all the formatted structural attributes of a sentence.
@@ -691,7 +790,7 @@ class KorpExportFormatter(object):
         get all attributes.
         """
         return qr.get_token_attrs(
-            token, None if all_attrs else self._opts.get("attrs", []))
+            token, None if all_attrs else self._token_attrnames)
 
     # Generic formatter methods used by the concrete formatter methods
     # for formatting individual components of a query result. These
@@ -706,9 +805,67 @@ class KorpExportFormatter(object):
         formatter handling missing keys in the format string. (The
         *item* in *item_type* does not refer to (only) list items, but
         to any component of a query result.)
+
+        Format strings whose replacement fields are only plain keys,
+        possibly with a format spec, such as ``{value}`` or
+        ``{name}="{value}"``, are parsed once and filled directly,
+        since the string formatter is relatively slow. The result is
+        the same as with the string formatter.
+        """
+        format_str = self._opts[item_type + "_format"]
+        try:
+            compiled_format = self._compiled_formats[format_str]
+        except KeyError:
+            compiled_format = self._compile_format(format_str)
+        if compiled_format is False:
+            return self._formatter.format(format_str, **format_args)
+        result = ""
+        for literal, key, spec in compiled_format:
+            result += literal
+            if key is None:
+                continue
+            # As in _LazyPartialStringFormatter, a KeyError or
+            # AttributeError when getting the value means a missing
+            # value, and a function value is called (possibly twice).
+            try:
+                value = format_args[key]
+                if callable(value):
+                    value = value()
+            except (KeyError, AttributeError):
+                value = None
+            if callable(value):
+                value = value()
+            result += (self._formatter.missing if value is None
+                       else format(value, spec))
+        return result
+
+    @classmethod
+    def _compile_format(cls, format_str):
+        """Parse `format_str` for `_format_item` and cache the result.
+
+        Return a tuple of (literal text, key name, format spec) for
+        the replacement fields in `format_str`, as described for
+        `_compiled_formats`, or `False` if `format_str` contains a
+        replacement field other than a plain key with an optional
+        format spec not containing nested fields, or if it cannot be
+        parsed. The result is stored in `_compiled_formats`.
         """
-        return self._formatter.format(self._opts[item_type + "_format"],
-                                      **format_args)
+        compiled_format = []
+        try:
+            for literal, key, spec, conversion in (
+                    cls._formatter.parse(format_str)):
+                if key is not None and (
+                        conversion or "{" in spec
+                        or not cls._format_key_re.match(key)):
+                    compiled_format = False
+                    break
+                compiled_format.append((literal, key, spec))
+        except ValueError:
+            compiled_format = False
+        if compiled_format is not False:
+            compiled_format = tuple(compiled_format)
+        cls._compiled_formats[format_str] = compiled_format
+        return compiled_format
 
     def _format_list(self, item_type, list_, format_fn=None, **kwargs):
         """Format the list `list_` of items of `item_type`.
@@ -726,22 +883,25 @@ class KorpExportFormatter(object):
         as a whole matches the regular expression, the list item is
         not included in the result.
         """
-
-        def updated(dict_, values):
-            dict_.update(values)
-            return dict_
-
         format_fn = format_fn or getattr(self, "_format_" + item_type)
-        skip_re = self._opts.get(item_type + "_skip")
-        if skip_re:
-            skip_re = re.compile(r"^" + skip_re + r"$", re.UNICODE)
-        return self._opts[item_type + "_sep"].join(
-            formatted_elem
-            for elemnum, elem in enumerate(list_)
-            for formatted_elem in [
-                    format_fn(elem, **updated(kwargs, dict([(item_type + "_num",
-                                                             elemnum)])))]
-            if not (skip_re and skip_re.match(formatted_elem)))
+        # Compile the skip regular expression only once for each item
+        # type, as lists of the same type are formatted for each
+        # sentence or token.
+        try:
+            skip_re = self._list_skip_res[item_type]
+        except KeyError:
+            skip_re = self._opts.get(item_type + "_skip")
+            if skip_re:
+                skip_re = re.compile(r"^" + skip_re + r"$", re.UNICODE)
+            self._list_skip_res[item_type] = skip_re
+        num_key = item_type + "_num"
+        formatted_list = []
+        for elemnum, elem in enumerate(list_):
+            kwargs[num_key] = elemnum
+            formatted_elem = format_fn(elem, **kwargs)
+            if not (skip_re and skip_re.match(formatted_elem)):
+                formatted_list.append(formatted_elem)
+        return self._opts[item_type + "_sep"].join(formatted_list)
 
     def _format_label_list_item(self, item_type, key, value, **format_args):
         """Format an item of a list whose items have labels.
@@ -880,9 +1040,13 @@ class KorpExportFormatter(object):
         """Format the current date.
 
         Format the current date using the `strftime` format in the
-        option ``date_format``.
+        option ``date_format``. The date is formatted only once, so
+        that it is the same in all parts of the content (for example,
+        in both header and footer).
         """
-        return time.strftime(self._opts["date_format"])
+        if self._formatted_date is None:
+            self._formatted_date = time.strftime(self._opts["date_format"])
+        return self._formatted_date
 
     def _format_hitcount(self, **format_args):
         """Format the total number of hits.
@@ -901,14 +1065,23 @@ class KorpExportFormatter(object):
         Format keys in ``params_format``: ``param`` (a dictionary of
         unformatted query parameters), ``params`` (a formatted list of
         query parameter fields), all parameter names as such.
+
+        The result without `format_args` is formatted only once and
+        reused.
         """
+        if not format_args and self._formatted_params is not None:
+            return self._formatted_params
+        cache_result = not format_args
         # Allow format references {name} as well as {param[name]}
         format_args.update(self._query_params)
-        return self._format_item(
+        result = self._format_item(
             "params",
             param=self._query_params,
             params=lambda: self._format_param_fields(),
             **format_args)
+        if cache_result:
+            self._formatted_params = result
+        return result
 
     def _format_param_fields(self, **format_args):
         """Format query parameters as a list.
@@ -989,24 +1162,22 @@ class KorpExportFormatter(object):
             hit_num=lambda: (int(self._infoitems["param"].get("start") or 0)
                              + kwargs["sentence_num"]),
             arg=kwargs)
-        tokens_type_info = [
-            ("tokens", dict(tokens_type="all")),
-            ("match", dict(match_mark=self._opts.get("match_marker", ""))),
-            ("left_context", {}),
-            ("right_context", {}),
-        ]
-        for tokens_type, opts in tokens_type_info:
-            if "tokens_type" not in opts:
-                opts["tokens_type"] = tokens_type
+        # Check the match options and get the match information and
+        # tokens only once for all the token types.
+        mark_matches = (self._opts["match_open"] or self._opts["match_close"]
+                        or self._opts["match_marker"])
+        match = qr.get_sentence_match(sentence)
+        tokens_by_type = qr.get_sentence_tokens_all_types(sentence)
+        for tokens_type, tokens_type2 in self._sentence_tokens_types:
+            opts = dict(tokens_type=tokens_type2)
+            if tokens_type == "match":
+                opts["match_mark"] = self._token_match_marks[2]
             opts.update(kwargs)
-            tokens = qr.get_sentence_tokens(sentence, opts["tokens_type"])
-            if (self._opts["match_open"] or self._opts["match_close"]
-                or self._opts["match_marker"]):
+            tokens = tokens_by_type[opts["tokens_type"]]
+            if mark_matches:
                 if tokens_type == "tokens":
-                    opts["match_start"] = qr.get_sentence_match_info(sentence,
-                                                                     "start")
-                    opts["match_end"] = qr.get_sentence_match_info(sentence,
-                                                                   "end")
+                    opts["match_start"] = match.get("start", -1)
+                    opts["match_end"] = match.get("end", -1)
                 elif tokens_type == "match":
                     opts["match_start"] = 0
                     opts["match_end"] = len(tokens)
@@ -1015,7 +1186,6 @@ class KorpExportFormatter(object):
             format_args[tokens_type] = (lambda tokens=tokens, opts=opts:
                                         self._format_tokens(tokens, **opts))
             for attrname in self._sentence_token_attrs:
-                tokens_type2 = tokens_type if tokens_type != "tokens" else "all"
                 format_arg_name = (self._sentence_token_attr_labels[attrname]
                                    + "_" + tokens_type2)
                 format_args[format_arg_name] = (
@@ -1024,20 +1194,17 @@ class KorpExportFormatter(object):
         format_args.update(kwargs)
         # Allow direct format references to struct names (unformatted
         # values)
-        format_args.update(dict(self._get_sentence_structs(sentence)))
+        format_args.update(self._get_sentence_structs(sentence))
         format_args.update(self._infoitems)
         format_args.update(corpus_info)
-        format_args.update(
-            dict(corpus_info=lambda: self._format_corpus_info(**format_args)))
-        format_args.update(
-            dict(info=lambda: self._format_item("sentence_info",
-                                                **format_args)))
+        format_args["corpus_info"] = (
+            lambda: self._format_corpus_info(**format_args))
+        format_args["info"] = (
+            lambda: self._format_item("sentence_info", **format_args))
         return self._format_item(
             "sentence",
             fields=lambda: self._format_list(
-                "sentence_field",
-                self._opts.get("sentence_fields", []),
-                **format_args),
+                "sentence_field", self._sentence_fields, **format_args),
             **format_args)
 
     def _format_sentence_field(self, key, **format_args):
@@ -1108,8 +1275,12 @@ class KorpExportFormatter(object):
         # In practice, currently Korp returns only a single aligned
         # sentence, but CWB supports multiple alignments, so support
         # it here as well.
+        aligned_sentences = qr.get_aligned_sentences(sentence)
+        if not aligned_sentences:
+            # Not a parallel corpus: skip setting up list formatting
+            return ""
         return self._format_list("aligned",
-                                 qr.get_aligned_sentences(sentence),
+                                 aligned_sentences,
                                  self._format_aligned_sentence,
                                  **kwargs)
 
@@ -1155,8 +1326,28 @@ class KorpExportFormatter(object):
         Format `tokens` as a list. Use ``token_format`` to format the
         individual tokens and ``token_sep`` to separate them.
         """
+        if self._tokens_as_words and "attr_only" not in kwargs:
+            return self._format_tokens_as_words(tokens, **kwargs)
         return self._format_list("token", tokens, **kwargs)
 
+    def _format_tokens_as_words(self, tokens, match_start=None,
+                                match_end=None, **kwargs):
+        """Format `tokens` as plain wordforms, marking a match.
+
+        A fast path of :method:`_format_tokens` producing the same
+        result as formatting each token with the default
+        ``token_noattrs_format``.
+        """
+        # Allow for None in word, as in _format_token
+        words = [token.get("word") or "" for token in tokens]
+        if match_end:
+            if 0 <= match_start < len(words):
+                words[match_start] = (self._opts.get("match_open", "")
+                                      + words[match_start])
+            if 0 < match_end <= len(words):
+                words[match_end - 1] += self._opts.get("match_close", "")
+        return self._opts["token_sep"].join(words)
+
     def _format_token(self, token, **kwargs):
         """Format a single token `token`, possibly with attributes.
 
@@ -1196,24 +1387,19 @@ class KorpExportFormatter(object):
                 **kwargs)
         if attrname != "word":
             format_name = "token_attr"
-        elif (self._opts.get("attrs") or self.structured_format
-              or len(self._opts.get("token_fields")) > 1):
-            format_name = "token"
         else:
-            format_name = "token_noattrs"
+            format_name = self._token_format_name
         format_args = dict(
             attrs=lambda: self._format_token_attrs(token),
             structs_open=lambda: self._format_token_structs_open(token),
             structs_close=lambda: self._format_token_structs_close(token))
         format_args[itemname] = attrval
         # Allow direct format references to attr names
-        format_args.update(dict(self._get_token_attrs(token)))
+        format_args.update(self._get_token_attrs(token))
         format_args.update(kwargs)
         if attrname == "word":
             fields = lambda: self._format_list(
-                "token_field",
-                self._opts.get("token_fields", []),
-                **format_args)
+                "token_field", self._token_fields, **format_args)
         else:
             fields = ""
         match_open = match_close = match_marker = ""
@@ -1222,11 +1408,11 @@ class KorpExportFormatter(object):
             match_start = kwargs.get("match_start")
             match_end = kwargs.get("match_end")
             if token_num == match_start:
-                match_open = self._opts.get("match_open", "")
+                match_open = self._token_match_marks[0]
             if token_num == match_end - 1:
-                match_close = self._opts.get("match_close", "")
+                match_close = self._token_match_marks[1]
             if match_start <= token_num < match_end:
-                match_marker = self._opts.get("match_marker", "")
+                match_marker = self._token_match_marks[2]
         result = self._format_item(
             format_name,
             fields=fields,
@@ -1257,6 +1443,9 @@ class KorpExportFormatter(object):
 
         Use ``attr_format`` to format the individual attributes and
         ``attr_sep`` to separate them."""
+        if self._token_attrs_as_values:
+            return self._opts["attr_sep"].join(
+                qr.get_token_attr_values(token, self._token_attrnames))
         return self._format_list(
             "attr",
             self._get_token_attrs(token),
@@ -1288,10 +1477,9 @@ class KorpExportFormatter(object):
         whether to combine structural attributes representing the
         attributes of the same element or not.
         """
-        combine = self.get_option_bool("combine_token_structs")
         return self._format_list(
             "token_struct_open",
-            qr.get_token_structs_open(token, combine),
+            qr.get_token_structs_open(token, self._combine_token_structs),
             **kwargs)
 
     def _format_token_struct_open(self, struct, **format_args):
@@ -1306,7 +1494,7 @@ class KorpExportFormatter(object):
         ``token_struct_open_attrs`` also recognizes ``attrs``
         containing a formatted list of attributes (in XML sense).
         """
-        if self.get_option_bool("combine_token_structs"):
+        if self._combine_token_structs:
             structname, attrlist = struct
             attrstr = lambda: self._format_token_struct_attrs(attrlist,
                                                               **format_args)
@@ -1353,8 +1541,7 @@ class KorpExportFormatter(object):
         """
         return self._format_list(
             "token_struct_close",
-            qr.get_token_structs_close(
-                token, self.get_option_bool("combine_token_structs")),
+            qr.get_token_structs_close(token, self._combine_token_structs),
             **kwargs)
 
     def _format_token_struct_close(self, struct, **format_args):
@@ -1364,7 +1551,7 @@ class KorpExportFormatter(object):
         of the structural attribute, or if ``combine_token_structs``
         is `True`, the XML element name in the structural attribute).
         """
-        if self.get_option_bool("combine_token_structs"):
+        if self._combine_token_structs:
             struct, _ = struct
         return self._format_item(
             "token_struct_close", name=struct, **format_args)
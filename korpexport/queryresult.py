@@ -65,13 +65,17 @@ def get_occurring_attrnames(query_result, keys, struct_name):
     # FIXME: This does not take into account attributes in aligned
     # sentences
     occurring_keys = set()
+    # Stop scanning the result as soon as all of keys have been found
+    keys_to_find = set(keys)
     for sent in get_sentences(query_result):
         result_struct = sent.get(struct_name)
         if isinstance(result_struct, list):
             for item in result_struct:
-                occurring_keys |= set(item.keys())
+                occurring_keys.update(item)
         elif result_struct:
-            occurring_keys |= set(result_struct.keys())
+            occurring_keys.update(result_struct)
+        if keys_to_find <= occurring_keys:
+            break
     return [key for key in keys if key in occurring_keys]
 
 
@@ -201,9 +205,43 @@ def get_sentence_tokens_right_context(sentence):
         sentence, get_sentence_match_info(sentence, "end"), None)
 
 
+_get_sentence_tokens_funcs = {
+    "all": get_sentence_tokens_all,
+    "match": get_sentence_tokens_match,
+    "left_context": get_sentence_tokens_left_context,
+    "right_context": get_sentence_tokens_right_context,
+}
+"""Functions for getting sentence tokens, keyed by the kind of tokens"""
+
+
 def get_sentence_tokens(sentence, type_):
     """Get the toknes in `sentence` of the kind specified by `type_`."""
-    return globals()["get_sentence_tokens_" + type_](sentence)
+    return _get_sentence_tokens_funcs[type_](sentence)
+
+
+def get_sentence_tokens_all_types(sentence):
+    """Get the tokens in `sentence` of all the kinds, as a dict.
+
+    The keys are those of `get_sentence_tokens`, and the values are
+    the same as it returns, but the match information is looked up
+    only once for all of them.
+    """
+    # Slice the token list directly instead of calling
+    # get_sentence_tokens_base for each kind, so that the tokens are
+    # also looked up only once.
+    tokens = sentence["tokens"]
+    match = get_sentence_match(sentence)
+    match_start = match.get("start", -1)
+    match_end = match.get("end", -1)
+    return {
+        "all": tokens[:],
+        "match": (get_sentence_tokens_base(sentence, match.get("start"),
+                                           match.get("end"))
+                  if match else []),
+        "left_context": (tokens[:match_start] if match_start >= 0
+                         else tokens[:]),
+        "right_context": tokens[match_end:] if match_end >= 0 else [],
+    }
 
 
 def get_sentence_match_position(sentence):
@@ -249,8 +287,16 @@ def get_sentence_structs(sentence, structnames=None):
 
 def get_sentence_struct_values(sentence, structnames=None):
     """Get a list of the structural attribute values of `sentence`."""
-    return [value for name, value in
-            get_sentence_structs(sentence, structnames)]
+    # Get the values directly instead of via get_sentence_structs, to
+    # avoid building (name, value) pairs only to discard the names
+    sentence_structs = sentence.get("structs")
+    if sentence_structs is None:
+        return []
+    elif structnames is None:
+        return list(sentence_structs.values())
+    else:
+        return [sentence_structs.get(structname) or ""
+                for structname in structnames]
 
 
 def get_token_attrs(token, attrnames=None):
@@ -272,6 +318,15 @@ def get_token_attrs(token, attrnames=None):
         return [(attrname, token.get(attrname) or "") for attrname in attrnames]
 
 
+def get_token_attr_values(token, attrnames):
+    """Get a list of the values of attributes `attrnames` of `token`.
+
+    A value `None` or a missing attribute is converted to an empty
+    string, as in `get_token_attrs`.
+    """
+    return [token.get(attrname) or "" for attrname in attrnames]
+
+
 def get_token_attr(token, attrname="word"):
     """Get a single (positional) attribute value of `token`.
 